@@ -4,6 +4,7 @@ import glob
 import json
 import os.path
 from collections import Counter
+from functools import lru_cache
 
 import pandas as pd
 from google.protobuf import json_format
@@ -19,6 +20,12 @@ from ..diff.schema import MDictDiff, MDictListDiff, MDict
 from ..utils import json_load, get_compounds, timeout
 
 
+@lru_cache(maxsize=1024)
+def _parse_reaction(text: str) -> reaction_pb2.Reaction:
+    """ keyed on the text so a reassigned `reference_text`/`inference_text` is parsed again """
+    return json_format.Parse(text, reaction_pb2.Reaction())
+
+
 class PairEvaluator(BaseModel):
     """ a pair of reaction messages in python dictionary form """
 
@@ -131,11 +138,13 @@ class PairEvaluator(BaseModel):
 
     @property
     def reaction_message_ref(self) -> reaction_pb2.Reaction:
-        return json_format.Parse(self.reference_text, reaction_pb2.Reaction())
+        """ parsed once per text and shared by all evaluations, do not modify """
+        return _parse_reaction(self.reference_text)
 
     @property
     def reaction_message_inf(self) -> reaction_pb2.Reaction:
-        return json_format.Parse(self.inference_text, reaction_pb2.Reaction())
+        """ parsed once per text and shared by all evaluations, do not modify """
+        return _parse_reaction(self.inference_text)
 
     def eval_role_clf(self) -> list[dict]:
         messages_inf = get_compounds(self.reaction_message_inf, extracted_from="inputs")
@@ -5,6 +5,7 @@ import itertools
 import json
 import math
 import signal
+import threading
 from collections.abc import MutableMapping
 from enum import Enum
 from functools import wraps
@@ -18,6 +19,11 @@ from google.protobuf import json_format
 from ord_schema.proto import reaction_pb2
 from scipy.optimize import linear_sum_assignment
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 class DeepDiffKey(str, Enum):
     values_changed = 'values_changed'
@@ -28,39 +34,63 @@ class DeepDiffKey(str, Enum):
     deep_distance = 'deep_distance'
 
 
+def iter_flatten(dictionary, parent_key=None):
+    """
+    Iterate over the leafs of a nested dictionary using an explicit stack, leafs are yielded in insertion order
+    An empty dict or list below the root is considered as a leaf of value `None`
+
+    :param dictionary: The dictionary to flatten, a list is also accepted and its indices become the first keys
+    :param parent_key: Path tuple prepended to every yielded path
+    :return: A generator of (`path tuple`, leaf value)
+    """
+    prefix = tuple(parent_key) if parent_key else ()
+    if isinstance(dictionary, list):
+        stack = [(prefix + (i,), dictionary[i]) for i in range(len(dictionary) - 1, -1, -1)]
+    else:
+        # only `dict` views are reversible, other mappings are materialized first
+        items = dictionary.items() if type(dictionary) is dict else list(dictionary.items())
+        stack = [(prefix + (key,), value) for key, value in reversed(items)]
+    # bound methods are looked up once, the loop body is the hot spot when evaluating diffs
+    pop = stack.pop
+    push = stack.append
+    while stack:
+        path, value = pop()
+        value_type = type(value)
+        # exact type checks first, `isinstance` against the ABC is slow and only needed for exotic mappings
+        if value_type is dict:
+            if value:
+                for key, sub_value in reversed(value.items()):
+                    push((path + (key,), sub_value))
+            else:
+                yield path, None
+        elif value_type is list or isinstance(value, list):
+            if value:
+                for i in range(len(value) - 1, -1, -1):
+                    push((path + (i,), value[i]))
+            else:
+                yield path, None
+        elif isinstance(value, MutableMapping):
+            # only `dict` views are reversible
+            if value:
+                for key, sub_value in reversed(list(value.items())):
+                    push((path + (key,), sub_value))
+            else:
+                yield path, None
+        else:
+            yield path, value
+
+
 def flatten(dictionary, parent_key=None):
     """
-    Taken from https://stackoverflow.com/a/62186294
     Turn a nested dictionary into a flattened dictionary
     Note if there is an integer in the path tuple, one cannot tell if it is a list index or a key,
     although usually integers are not used as keys in ord messages.
 
     :param dictionary: The dictionary to flatten
-    :param parent_key: Argument used in recursive
+    :param parent_key: Path tuple prepended to every key of the flattened dictionary
     :return: A flattened dictionary where keys are `path tuples` to reach leafs
     """
-
-    items = []
-    for key, value in dictionary.items():
-        if parent_key:
-            new_key = list(parent_key) + [key, ]
-        else:
-            new_key = [key, ]
-        new_key = tuple(new_key)
-        if isinstance(value, MutableMapping):
-            if not value.items():
-                items.append((new_key, None))
-            else:
-                items.extend(flatten(value, new_key).items())
-        elif isinstance(value, list):
-            if len(value):
-                for k, v in enumerate(value):
-                    items.extend(flatten({k: v}, new_key).items())
-            else:
-                items.append((new_key, None))
-        else:
-            items.append((new_key, value))
-    return dict(items)
+    return dict(iter_flatten(dictionary, parent_key))
 
 
 def flat_deepdiff_entry(t, path_list) -> dict[tuple[str | int, ...], str | int | float | None]:
@@ -73,13 +103,12 @@ def flat_deepdiff_entry(t, path_list) -> dict[tuple[str | int, ...], str | int |
     """
     path_tuple = tuple(path_list)
     if isinstance(t, dict):
-        t1 = flatten(t)
-        t1_from_root = {tuple(path_list + list(k)): v for k, v in t1.items()}
+        t1_from_root = dict(iter_flatten(t, path_tuple))
     elif isinstance(t, list):
-        dummy_header = "DUMMY" * 3
-        dummy_t = {dummy_header: t}
-        t1 = flatten(dummy_t)
-        t1_from_root = {tuple(path_list + list(k)[1:]): v for k, v in t1.items()}
+        if t:
+            t1_from_root = dict(iter_flatten(t, path_tuple))
+        else:
+            t1_from_root = {path_tuple: None}
     elif isinstance(t, NotPresent):
         t1_from_root = {path_tuple: None}
     else:
@@ -91,56 +120,63 @@ def get_dict_depth(d):
     """ get the max depth of a nested dict """
     if not isinstance(d, dict) or not d:
         return 0
-    else:
-        return max(get_dict_depth(v) for k, v in d.items()) + 1
+    max_depth = 0
+    stack = [(1, d)]
+    while stack:
+        depth, node = stack.pop()
+        if depth > max_depth:
+            max_depth = depth
+        for v in node.values():
+            if isinstance(v, dict) and v:
+                stack.append((depth + 1, v))
+    return max_depth
 
 
 def find_best_match(indices1: list[int], indices2: list[int | None], distance_matrix: np.ndarray):
-    """ given a distance matrix and two lists of indices, find the best index match """
-
-    row_ind, col_ind = linear_sum_assignment(distance_matrix)
-    row = [indices1[i] for i in row_ind]
-    col = [indices2[i] for i in col_ind]
-
-    assignment = dict(zip(row, col))
-    for i1 in indices1:
-        try:
-            assignment[i1]
-        except KeyError:
-            assignment[i1] = None
-    if len(indices1) < 5:
-        cost = distance_matrix[row_ind, col_ind].sum()
-        assignment_bf, cost_bf = find_best_match_bf(indices1, indices2, distance_matrix)
-        try:
-            assert abs(cost - cost_bf) < 1e-5
-        except AssertionError:
-            print(assignment)
-            print(assignment_bf)
-            raise AssertionError
+    """
+    given a distance matrix and two lists of indices, find the best index match
+    `None` in `indices2` is a placeholder with zero cost, this is solved as a rectangular linear sum assignment
+    """
+    distance_matrix = np.asarray(distance_matrix)
+    indices2_present = [i2 for i2 in indices2 if i2 is not None]
+    n_none = len(indices2) - len(indices2_present)
+
+    cost = distance_matrix[np.ix_(indices1, indices2_present)]
+    if n_none:
+        cost = np.hstack([cost, np.zeros((len(indices1), n_none))])
+    candidates = indices2_present + [None] * n_none
+
+    row_ind, col_ind = linear_sum_assignment(cost)
+    assignment = {i1: None for i1 in indices1}
+    for i, j in zip(row_ind, col_ind):
+        assignment[indices1[i]] = candidates[j]
     return assignment
 
 
 def find_best_match_bf(indices1: list[int], indices2: list[int | None], distance_matrix):
     """
     given a distance matrix and two lists of indices, find the best index match
-    brutal force implementation, only used for debug
+    brutal force implementation, only used for debug, nothing in the package calls it,
+    use `find_best_match` instead
+    all permutations are scored at once, `None` points to an extra zero column of the distance matrix,
+    note the permutation matrix holds P(len(indices2), len(indices1)) x len(indices1) integers
     """
-    match_space = itertools.permutations(indices2, r=len(indices1))
-    best_match_distance = math.inf
-    best_match_solution = None
+    if not indices1:
+        return dict(), 0
+    distance_matrix = np.asarray(distance_matrix, dtype=float)
+    n_rows, n_cols = distance_matrix.shape
+    distance_matrix_padded = np.hstack([distance_matrix, np.zeros((n_rows, 1))])
+    indices2_padded = [n_cols if i2 is None else i2 for i2 in indices2]
 
-    for match in match_space:
-        match_distance = 0
-        for i1, i2 in zip(indices1, match):
-            if i2 is None:
-                continue
-            match_distance += distance_matrix[i1][i2]
-        if match_distance < best_match_distance:
-            best_match_distance = match_distance
-            best_match_solution = match
+    match_space = np.fromiter(
+        itertools.chain.from_iterable(itertools.permutations(indices2_padded, r=len(indices1))), dtype=np.int64
+    ).reshape(-1, len(indices1))
+    assert len(match_space)
+    match_distances = distance_matrix_padded[np.asarray(indices1)[None, :], match_space].sum(axis=1)
+    i_best = match_distances.argmin()
 
-    assert best_match_solution is not None
-    return dict(zip(indices1, [*best_match_solution])), best_match_distance
+    best_match_solution = [None if i2 == n_cols else int(i2) for i2 in match_space[i_best]]
+    return dict(zip(indices1, best_match_solution)), match_distances[i_best]
 
 
 def parse_deepdiff(dd: DeepDiff):
@@ -158,7 +194,8 @@ def parse_deepdiff(dd: DeepDiff):
     leaf_paths_removed = []
     leaf_paths_altered_1 = []
     leaf_paths_altered_2 = []
-    for dd_report_key, v in dd.to_dict().items():
+    # `dd` is in tree view so `dd.tree` already holds the `DiffLevel` sets, no need to materialize `dd.to_dict()`
+    for dd_report_key, v in dd.tree.items():
         dd_report_key: str
         v: PrettyOrderedSet[DiffLevel] | float
         if dd_report_key == DeepDiffKey.deep_distance.value:
@@ -166,8 +203,10 @@ def parse_deepdiff(dd: DeepDiff):
             continue
         assert dd_report_key in REPORT_KEYS  # this contains all keys from DeepDiff
         for value_altered_level in v:
-            is_t1_none = isinstance(value_altered_level.t1, NotPresent)
-            is_t2_none = isinstance(value_altered_level.t2, NotPresent)
+            t1 = value_altered_level.t1
+            t2 = value_altered_level.t2
+            is_t1_none = isinstance(t1, NotPresent)
+            is_t2_none = isinstance(t2, NotPresent)
 
             path_list_to_t1 = value_altered_level.path(output_format='list', use_t2=False)
             path_list_to_t2 = value_altered_level.path(output_format='list', use_t2=True)
@@ -175,22 +214,22 @@ def parse_deepdiff(dd: DeepDiff):
             #  this only happens when `ignore_order` is used and the path for d1 remains correct
             #  this originates from `DeepDiff` rather than `DiffLevel`
 
-            t1_leafs_from_root = flat_deepdiff_entry(value_altered_level.t1, path_list_to_t1)
-            t2_leafs_from_root = flat_deepdiff_entry(value_altered_level.t2, path_list_to_t2)
+            t1_leafs_from_root = flat_deepdiff_entry(t1, path_list_to_t1)
+            t2_leafs_from_root = flat_deepdiff_entry(t2, path_list_to_t2)
 
             if is_t1_none and not is_t2_none:
                 paths_added.append(path_list_to_t2)
-                leaf_paths_added += list(t2_leafs_from_root.keys())
+                leaf_paths_added.extend(t2_leafs_from_root)
             elif not is_t1_none and is_t2_none:
                 paths_removed.append(path_list_to_t1)
-                leaf_paths_removed += list(t1_leafs_from_root.keys())
+                leaf_paths_removed.extend(t1_leafs_from_root)
             elif not is_t1_none and not is_t2_none:
                 # TODO note this assignment may not be the actual assignment for leafs:
                 #  ex. I can have a sub-field in t1 removed
                 paths_altered_1.append(path_list_to_t1)
                 paths_altered_2.append(path_list_to_t2)
-                leaf_paths_altered_1 += list(t1_leafs_from_root.keys())
-                leaf_paths_altered_2 += list(t2_leafs_from_root.keys())
+                leaf_paths_altered_1.extend(t1_leafs_from_root)
+                leaf_paths_altered_2.extend(t2_leafs_from_root)
             else:
                 raise ValueError
     return (
@@ -207,38 +246,92 @@ def flat_list_of_lists(lol: list[list]) -> tuple[list, dict[tuple[int, int], int
     :param lol: list of lists
     :return: the flat list, a map of <tuple index of lol (i,j)> -> <flat list index>
     """
-    flat = []
-    map_lol_to_flat = dict()
-    i_flat = 0
-    for i, sub_list in enumerate(lol):
-        for j, item in enumerate(sub_list):
-            flat.append(item)
-            map_lol_to_flat[(i, j)] = i_flat
-            i_flat += 1
+    flat = list(itertools.chain.from_iterable(lol))
+    lens = [len(sub_list) for sub_list in lol]
+    starts = itertools.accumulate([0] + lens[:-1])
+    map_lol_to_flat = {(i, j): start + j for i, (start, n) in enumerate(zip(starts, lens)) for j in range(n)}
     return flat, map_lol_to_flat
 
 
-def json_dump(filename, obj, gz=False, indent=None):
-    if gz:
-        open_file = gzip.open
+def _has_non_finite_float(obj) -> bool:
+    """ if there is a float `nan`/`inf` in a nested structure of dicts and lists """
+    stack = [obj]
+    while stack:
+        value = stack.pop()
+        if isinstance(value, float):
+            if not math.isfinite(value):
+                return True
+        elif isinstance(value, MutableMapping):
+            stack.extend(value.values())
+        elif isinstance(value, (list, tuple)):
+            stack.extend(value)
+    return False
+
+
+def _json_dumps(obj, indent=None) -> bytes:
+    """
+    serialize to UTF-8 json bytes, `orjson` is used if available,
+    `json` is used for what `orjson` cannot write the same way:
+    indents other than 2, objects `orjson` cannot serialize (e.g. numpy scalars, integers beyond 64 bits),
+    and float `nan`/`inf` which `orjson` would write as `null` rather than `NaN`/`Infinity`
+    """
+    if orjson is not None and indent in (None, 2):
+        option = orjson.OPT_NON_STR_KEYS
+        if indent == 2:
+            option |= orjson.OPT_INDENT_2
+        try:
+            data = orjson.dumps(obj, option=option)
+        except orjson.JSONEncodeError:
+            data = None
+        # a non-finite float can only be behind a `null` in the output, so the walk is usually skipped
+        if data is not None and not (b"null" in data and _has_non_finite_float(obj)):
+            return data
+    return json.dumps(obj, indent=indent).encode("UTF-8")
+
+
+def _json_loads(data: bytes):
+    """
+    parse json bytes, use `orjson` if available,
+    `orjson` rejects the `NaN`/`Infinity` literals written by `json`, such files are parsed by `json` instead
+    """
+    if orjson is None:
+        return json.loads(data)
+    try:
+        return orjson.loads(data)
+    except orjson.JSONDecodeError:
+        return json.loads(data)
+
+
+def json_dump(filename, obj, gz=False, indent=None, compresslevel=1):
+    """
+    dump to a json file, `.gz` (with `gz=True`) and `.zst` files are compressed
+    """
+    # serialize first so the compressor works on one large buffer
+    data = _json_dumps(obj, indent=indent)
+    if filename.endswith(".zst"):
+        import zstandard  # only needed for `.zst` files
+        with open(filename, 'wb') as f:
+            f.write(zstandard.ZstdCompressor(level=3).compress(data))
+    elif gz:
         assert filename.endswith(".gz")
-        with open_file(filename, 'wt', encoding="UTF-8") as f:
-            json.dump(obj, f, indent=indent)
+        with gzip.open(filename, 'wb', compresslevel=compresslevel) as f:
+            f.write(data)
     else:
-        open_file = open
-        with open_file(filename, 'w', encoding="UTF-8") as f:
-            json.dump(obj, f, indent=indent)
+        with open(filename, 'wb') as f:
+            f.write(data)
 
 
 def json_load(filename):
-    if filename.endswith(".gz"):
-        open_file = gzip.open
-        with open_file(filename, 'rt', encoding="UTF-8") as f:
-            return json.load(f)
-    else:
-        open_file = open
-        with open_file(filename, 'r', encoding="UTF-8") as f:
-            return json.load(f)
+    """ load a json file, `.gz` and `.zst` files are decompressed, `NaN`/`Infinity` literals are accepted """
+    # read the whole file then parse, rather than letting `json.load` stream small chunks
+    if filename.endswith(".zst"):
+        import zstandard  # only needed for `.zst` files
+        # a streaming reader also handles frames that do not record their content size
+        with open(filename, 'rb') as f, zstandard.ZstdDecompressor().stream_reader(f) as reader:
+            return _json_loads(reader.read())
+    open_file = gzip.open if filename.endswith(".gz") else open
+    with open_file(filename, 'rb') as f:
+        return _json_loads(f.read())
 
 
 def strip_empty_fields(d: dict):
@@ -255,6 +348,9 @@ def strip_empty_fields(d: dict):
 def timeout(seconds, default=None):
     """
     timeout decorator for high cost functions
+    in the main thread the call is interrupted by `SIGALRM`,
+    signals are not available in other threads so there the call runs in a daemon thread,
+    a timed out call in a daemon thread cannot be stopped and keeps running in the background until it returns
 
     :param seconds:
     :param default:
@@ -264,6 +360,9 @@ def timeout(seconds, default=None):
     def decorator(func):
         @wraps(func)
         def wrapper(*args, **kwargs):
+            if threading.current_thread() is not threading.main_thread():
+                return _call_in_daemon_thread(func, args, kwargs, seconds, default)
+
             def signal_handler(signum, frame):
                 raise TimeoutError("Timed out!")
 
@@ -287,6 +386,28 @@ def timeout(seconds, default=None):
     return decorator
 
 
+def _call_in_daemon_thread(func, args, kwargs, seconds, default):
+    """ the thread based fallback of `timeout` for calls outside the main thread """
+    outcome = dict()
+
+    def target():
+        try:
+            outcome["result"] = func(*args, **kwargs)
+        except BaseException as e:
+            outcome["error"] = e
+
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(seconds)
+    if thread.is_alive():
+        return default
+    if "error" in outcome:
+        if isinstance(outcome["error"], TimeoutError):
+            return default
+        raise outcome["error"]
+    return outcome["result"]
+
+
 def get_compounds(reaction_message: reaction_pb2.Reaction, extracted_from: str) -> list[
     reaction_pb2.Compound | reaction_pb2.ProductCompound]:
     if extracted_from == "inputs":
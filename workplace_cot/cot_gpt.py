@@ -1,10 +1,15 @@
+import json
 import pprint
 import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
 from pathlib import Path
 
 import tiktoken
 import tqdm
-from openai import OpenAI
+from loguru import logger
+from openai import OpenAI, RateLimitError
 from pandas._typing import FilePath
 
 from ord.utils import json_load, json_dump
@@ -13,6 +18,10 @@ _API_KEY = "YOUR_API_KEY"
 Client = OpenAI(api_key=_API_KEY)
 MODEL_NAME = "gpt-3.5-turbo-0125"
 MAX_TOKENS = 3000
+MAX_WORKERS = 16
+MAX_RETRIES = 5
+BATCH_MIN_SAMPLES = 5
+BATCH_POLL_SECONDS = 60
 
 
 def print_models():
@@ -27,25 +36,42 @@ def sample_test_set(test_json: FilePath, k=100):
     return sorted(test_set, key=lambda x: x['reaction_id'])
 
 
-def get_cot_prompt(procedure_text: str, cot_prefix_file: str = "cot_prefix.txt"):
+@lru_cache(maxsize=4)
+def _read_prefix(cot_prefix_file: str):
     with open(cot_prefix_file, "r") as f:
-        cot_prefix = f.read()
+        return f.read()
+
 
-    prompt = f"""{cot_prefix}
+def get_cot_prompt(procedure_text: str, cot_prefix_file: str = "cot_prefix.txt"):
+    prompt = f"""{_read_prefix(cot_prefix_file)}
 Here is a new reacton_text.
 new_reaction_text = ```{procedure_text}```
 Please follow the above instructions and the workflow for dealing the two given examples. Extract and return the ORD JSON record."""
     return prompt
 
 
+@lru_cache(maxsize=1)
+def _enc():
+    return tiktoken.get_encoding("cl100k_base")
+
+
 def calculate_tokens(prompt: str):
-    enc = tiktoken.get_encoding("cl100k_base")
-    return len(enc.encode(prompt))
+    return len(_enc().encode(prompt))
 
 
 def get_response(procedure_text: str):
     prompt = get_cot_prompt(procedure_text)
-    response = Client.chat.completions.create(
+    for i_retry in range(MAX_RETRIES):
+        try:
+            return _create_completion(prompt)
+        except RateLimitError:
+            if i_retry == MAX_RETRIES - 1:
+                raise
+            time.sleep(2 ** i_retry)
+
+
+def _completion_body(prompt: str) -> dict:
+    return dict(
         model=MODEL_NAME,
         messages=[
             {
@@ -62,23 +88,85 @@ def get_response(procedure_text: str):
         # max_tokens=TOKEN_LIMIT - calculate_tokens(prompt),
         top_p=1
     )
+
+
+def _create_completion(prompt: str):
+    response = Client.chat.completions.create(**_completion_body(prompt))
     return response
 
 
+def _run(data: dict, dump_folder: FilePath):
+    reaction_text = data['procedure_text']
+    reaction_id = data['reaction_id']
+    dump_file = f"{dump_folder}/{reaction_id}.json"
+    # if os.path.isfile(dump_file):
+    #     if json_load(dump_file)['choices'][0]['finish_reason'] == 'stop':
+    #         return
+    #     else:
+    #         logger.warning(f"found a unfinished call: {reaction_id}, retrying")
+    gpt_response = get_response(reaction_text)
+    # pydantic serializes to json directly, skipping the intermediate dict of `model_dump`
+    with open(dump_file, "w", encoding="UTF-8") as f:
+        f.write(gpt_response.model_dump_json(indent=2))
+
+
+def _run_batch(test_set_samples: list[dict], dump_folder: FilePath):
+    """ submit all samples as one job of the batch api, wait for it and dump the response body of each sample """
+    batch_lines = [
+        json.dumps(
+            {
+                "custom_id": data['reaction_id'],
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": _completion_body(get_cot_prompt(data['procedure_text'])),
+            }
+        ) for data in test_set_samples
+    ]
+    batch_input_file = Client.files.create(
+        file=("batch_input.jsonl", "\n".join(batch_lines).encode("UTF-8")), purpose="batch"
+    )
+    batch = Client.batches.create(
+        input_file_id=batch_input_file.id, endpoint="/v1/chat/completions", completion_window="24h"
+    )
+    while batch.status not in ("completed", "failed", "expired", "cancelled"):
+        time.sleep(BATCH_POLL_SECONDS)
+        batch = Client.batches.retrieve(batch.id)
+    if batch.status != "completed":
+        raise RuntimeError(f"batch {batch.id} ended with status: {batch.status}")
+    logger.critical(f"batch {batch.id} request counts: {batch.request_counts}")
+
+    dumped_ids = set()
+    if batch.output_file_id is not None:
+        for line in Client.files.content(batch.output_file_id).text.splitlines():
+            result = json.loads(line)
+            reaction_id = result['custom_id']
+            if result['error'] is not None or result['response']['status_code'] != 200:
+                logger.warning(f"batch request failed for: {reaction_id}")
+                continue
+            json_dump(f"{dump_folder}/{reaction_id}.json", result['response']['body'], indent=2)
+            dumped_ids.add(reaction_id)
+
+    # failed requests are written to a separate error file
+    if batch.error_file_id is not None:
+        for line in Client.files.content(batch.error_file_id).text.splitlines():
+            result = json.loads(line)
+            logger.warning(f"batch request failed for: {result['custom_id']}\n{result['error'] or result['response']}")
+
+    missing_ids = [data['reaction_id'] for data in test_set_samples if data['reaction_id'] not in dumped_ids]
+    if missing_ids:
+        logger.critical(f"no response dumped for {len(missing_ids)}/{len(test_set_samples)} samples: {missing_ids}")
+
+
 def cot_experiment(test_json: FilePath, k: int, dump_folder: FilePath):
     test_set_samples = sample_test_set(test_json, k)
     Path(dump_folder).mkdir(parents=True, exist_ok=True)
-    for data in tqdm.tqdm(test_set_samples):
-        reaction_text = data['procedure_text']
-        reaction_id = data['reaction_id']
-        dump_file = f"{dump_folder}/{reaction_id}.json"
-        # if os.path.isfile(dump_file):
-        #     if json_load(dump_file)['choices'][0]['finish_reason'] == 'stop':
-        #         continue
-        #     else:
-        #         logger.warning(f"found a unfinished call: {reaction_id}, retrying")
-        gpt_response = get_response(reaction_text)
-        json_dump(dump_file, gpt_response.model_dump(), indent=2)
+    if len(test_set_samples) >= BATCH_MIN_SAMPLES:
+        _run_batch(test_set_samples, dump_folder)
+        return
+    # too few samples to wait for a batch job, requests are io bound, send them concurrently
+    with ThreadPoolExecutor(MAX_WORKERS) as executor:
+        list(tqdm.tqdm(executor.map(partial(_run, dump_folder=dump_folder), test_set_samples),
+                       total=len(test_set_samples)))
 
 
 if __name__ == '__main__':